@@ -130,6 +130,12 @@ def get_parsed_args(argv=None, default_command="voice"):
         parents=[chat_options_parser],
         help="Run the chat on the terminal.",
     )
+    parser_terminal.add_argument(
+        "--n-prompts-per-batch",
+        type=int,
+        default=5,
+        help="Number of prompts answered per API call when prompts are piped in.",
+    )
     parser_terminal.set_defaults(run_command=terminal_chat)
 
     # Accounting report
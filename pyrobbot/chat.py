@@ -2,9 +2,15 @@
 """Implementation of the Chat class."""
 import datetime
 import json
+import os
+import re
 import shutil
+import sys
 import uuid
+import weakref
 from collections import defaultdict
+from functools import cached_property
+from pathlib import Path
 from typing import Optional
 
 import openai
@@ -13,10 +19,20 @@ from loguru import logger
 from . import GeneralConstants
 from .chat_configs import ChatOptions
 from .chat_context import EmbeddingBasedChatContext, FullHistoryChatContext
-from .general_utils import AlternativeConstructors, ReachedMaxNumberOfAttemptsError
-from .internet_utils import websearch
-from .openai_utils import make_api_chat_completion_call
-from .tokens import TokenUsageDatabase
+from .embeddings_database import EmbeddingsDatabase
+from .general_utils import (
+    AlternativeConstructors,
+    ReachedMaxNumberOfAttemptsError,
+    json_dumps,
+    json_loads,
+)
+from .tokens import (
+    N_TOKENS_REPLY_PRIMING,
+    TokenUsageDatabase,
+    close_write_connections,
+    get_encoding,
+    get_n_tokens_from_msgs,
+)
 
 
 class Chat(AlternativeConstructors):
@@ -29,6 +45,25 @@ class Chat(AlternativeConstructors):
 
     _translation_cache = defaultdict(dict)
     default_configs = ChatOptions()
+    # Names of the config fields. Computed once per class, see `__init_subclass__`.
+    _config_fields = tuple(default_configs.model_fields)
+
+    # Cached properties and the attributes they are computed from. The cached values
+    # are discarded whenever any of these attributes is changed.
+    _cached_properties_dependencies = {
+        **dict.fromkeys(
+            ["_base_directive", "_base_directive_n_tokens"],
+            (
+                "assistant_name",
+                "model",
+                "username",
+                "ai_instructions",
+                "system_name",
+                "_base_directive_date",
+            ),
+        ),
+        **dict.fromkeys(["configs_file", "context_file_path", "metadata_file"], ("id",)),
+    }
 
     def __init__(self, configs: ChatOptions = default_configs):
         """Initializes a chat instance.
@@ -43,12 +78,35 @@ class Chat(AlternativeConstructors):
         self.initial_openai_key_hash = GeneralConstants.openai_key_hash()
 
         self._passed_configs = configs
-        for field in self._passed_configs.model_fields:
+        for field in self._config_fields:
             setattr(self, field, self._passed_configs[field])
+        self._configs_dirty = True
+
+        self._register_finalizer()
+
+        # Pre-warm the tokenizers' cache, as creating encodings is expensive
+        for model in [self.model, self.context_model]:
+            get_encoding(model)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._config_fields = tuple(cls.default_configs.model_fields)
 
     @property
     def base_directive(self):
-        """Return the base directive for the LLM."""
+        """Return the base directive for the LLM.
+
+        The directive is used in every prompt, so it is computed again only if the
+        attributes it depends on have changed or if the date has changed.
+        """
+        today = datetime.date.today()
+        if self.__dict__.get("_base_directive_date") != today:
+            # Discards the outdated directive. See `__setattr__`.
+            self._base_directive_date = today
+        return self._base_directive
+
+    @cached_property
+    def _base_directive(self):
         msg_content = " ".join(
             [
                 instruction.strip()
@@ -56,9 +114,11 @@ class Chat(AlternativeConstructors):
                     f"Your name is {self.assistant_name}. Your model is {self.model}.",
                     f"You are a helpful assistant to {self.username}.",
                     " ".join(
-                        [f"{instruct.strip(' .')}." for instruct in self.ai_instructions]
+                        f"{instruction.strip(' .')}."
+                        for instruction in self.ai_instructions
+                        if instruction.strip(" .")
                     ),
-                    f"Today is {datetime.datetime.today().strftime('%A, %Y-%m-%d')}. ",
+                    f"Today is {self._base_directive_date.strftime('%A, %Y-%m-%d')}. ",
                     f"The current city is {GeneralConstants.IPINFO['city']} in ",
                     f"{GeneralConstants.IPINFO['country_name']}, ",
                     f"You must observe and follow all directives by {self.system_name} ",
@@ -75,13 +135,34 @@ class Chat(AlternativeConstructors):
         )
         return {"role": "system", "name": self.system_name, "content": msg_content}
 
+    @cached_property
+    def _base_directive_n_tokens(self):
+        """Number of tokens in the base directive, excluding reply priming tokens."""
+        n_tokens = get_n_tokens_from_msgs(
+            messages=[self.base_directive], encoder=get_encoding(self.model)
+        )
+        return n_tokens - N_TOKENS_REPLY_PRIMING
+
     @property
     def configs(self):
-        """Return the chat's configs after initialisation."""
-        configs_dict = {}
-        for field_name in self._passed_configs.model_fields:
-            configs_dict[field_name] = getattr(self, field_name)
-        return self._passed_configs.model_validate(configs_dict)
+        """Return the chat's configs after initialisation.
+
+        The configs are validated again only if any of them has been reassigned since
+        the last access. A copy is returned, so the validated configs are not touched
+        by changes made to it.
+        """
+        if self._configs_dirty:
+            configs_dict = {}
+            for field_name in self._config_fields:
+                # The greeting may change every time it is read (e.g., translated),
+                # so it is left out of the validated configs and added on each access
+                if field_name != "initial_greeting":
+                    configs_dict[field_name] = getattr(self, field_name)
+            self._configs = self._passed_configs.model_validate(configs_dict)
+            self._configs_dirty = False
+        return self._configs.model_copy(
+            update={"initial_greeting": self.initial_greeting}
+        )
 
     @property
     def user_cache_dir(self):
@@ -91,19 +172,25 @@ class Chat(AlternativeConstructors):
     @property
     def cache_dir(self):
         """Return the cache directory for this chat."""
-        directory = self.user_cache_dir / f"chat_{self.id}"
+        directory = self._cache_dir_path
         directory.mkdir(parents=True, exist_ok=True)
         return directory
 
     @property
+    def _cache_dir_path(self):
+        """Path of the chat cache directory. Unlike `cache_dir`, it is not created."""
+        return self.user_cache_dir / f"chat_{self.id}"
+
+    @cached_property
     def configs_file(self):
         """File to store the chat's configs."""
         return self.cache_dir / "configs.json"
 
-    @property
+    @cached_property
     def context_file_path(self):
         """Return the path to the file that stores the chat context and history."""
-        return self.cache_dir / "embeddings.db"
+        # The database creates the directory itself if needed
+        return self._cache_dir_path / "embeddings.db"
 
     @property
     def context_handler(self):
@@ -126,39 +213,38 @@ class Chat(AlternativeConstructors):
         """Return the general token usage database for all chats."""
         return TokenUsageDatabase(fpath=self.cache_dir.parent / "token_usage.db")
 
-    @property
+    @cached_property
     def metadata_file(self):
         """File to store the chat metadata."""
         return self.cache_dir / "metadata.json"
 
-    @property
+    @cached_property
     def metadata(self):
         """Keep metadata associated with the chat."""
         try:
-            _ = self._metadata
-        except AttributeError:
-            try:
-                with open(self.metadata_file, "r") as f:
-                    self._metadata = json.load(f)
-            except (FileNotFoundError, json.decoder.JSONDecodeError):
-                self._metadata = {}
-        return self._metadata
-
-    @metadata.setter
-    def metadata(self, value):
-        self._metadata = dict(value)
+            with open(self.metadata_file, "r") as f:
+                return json_loads(f.read())
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return {}
 
     def save_cache(self):
         """Store the chat's configs and metadata to the cache directory."""
         self.configs.export(self.configs_file)
 
-        metadata = self.metadata  # Trigger loading metadata if not yet done
-        metadata["chat_id"] = self.id
-        with open(self.metadata_file, "w") as metadata_f:
-            json.dump(metadata, metadata_f, indent=2)
+        # Metadata that have never been loaded are unchanged. Only write them if needed.
+        if "metadata" in self.__dict__ or not self.metadata_file.exists():
+            metadata = self.metadata
+            metadata["chat_id"] = self.id
+            # Write to a temporary file first, so the metadata file is never left
+            # half-written if the process is interrupted
+            tmp_metadata_file = self.metadata_file.with_suffix(".json.tmp")
+            with open(tmp_metadata_file, "w") as metadata_f:
+                metadata_f.write(json_dumps(metadata))
+            os.replace(tmp_metadata_file, self.metadata_file)
 
     def clear_cache(self):
         """Remove the cache directory."""
+        close_write_connections(directory=self.cache_dir)
         shutil.rmtree(self.cache_dir, ignore_errors=True)
 
     def load_history(self):
@@ -194,6 +280,39 @@ class Chat(AlternativeConstructors):
         """Respond to a system prompt."""
         yield from self._respond_prompt(prompt=prompt, role="system", **kwargs)
 
+    def respond_prompts(self, prompts: list[str], **kwargs):
+        """Respond to several user prompts with a single API call.
+
+        The prompts are sent as a single numbered list, which saves repeating the
+        base directive and context for each of them.
+
+        Args:
+            prompts (list[str]): The user prompts.
+            **kwargs: Passed to `respond_user_prompt`.
+
+        Returns:
+            list[str]: The replies to each of the `prompts`, in the same order. If the
+                reply cannot be split into one reply per prompt (e.g., if the model does
+                not number its answers), a list containing only the whole reply.
+        """
+        prompts = [prompt.strip() for prompt in prompts]
+        if not prompts:
+            return []
+        if len(prompts) == 1:
+            return ["".join(self.respond_user_prompt(prompt=prompts[0], **kwargs))]
+
+        batched_prompt = (
+            f"Answer each of the following {len(prompts)} prompts separately. Start "
+            "each answer in a new line, prefixed by the prompt's number in square "
+            "brackets (e.g., [1]). Do not repeat the prompts.\n\n"
+        )
+        batched_prompt += "\n".join(
+            f"[{i_prompt}] {prompt}" for i_prompt, prompt in enumerate(prompts, start=1)
+        )
+        reply = "".join(self.respond_user_prompt(prompt=batched_prompt, **kwargs))
+        replies = _split_batched_reply(reply=reply, n_prompts=len(prompts))
+        return [reply.strip()] if replies is None else replies
+
     def yield_response_from_msg(
         self, prompt_msg: dict, add_to_history: bool = True, **kwargs
     ):
@@ -209,16 +328,30 @@ class Chat(AlternativeConstructors):
         self, prompt_msg: dict, add_to_history: bool = True, skip_check: bool = False
     ):
         """Yield response from a prompt message."""
+        # Import here, as this pulls heavy dependencies not needed to just create a chat
+        from .internet_utils import websearch
+        from .openai_utils import make_api_chat_completion_call
+
         # Get appropriate context for prompt from the context handler
         context = self.context_handler.get_context(msg=prompt_msg)
 
+        # Count input tokens reusing the base directive's (cached) token count. The
+        # directive is read first, so that its token count is discarded if outdated.
+        base_directive = self.base_directive
+        n_input_tokens = self._base_directive_n_tokens + get_n_tokens_from_msgs(
+            messages=[*context, prompt_msg], encoder=get_encoding(self.model)
+        )
+
         # Make API request and yield response chunks
-        full_reply_content = ""
+        reply_chunks = []
         for chunk in make_api_chat_completion_call(
-            conversation=[self.base_directive, *context, prompt_msg], chat_obj=self
+            conversation=[base_directive, *context, prompt_msg],
+            chat_obj=self,
+            n_input_tokens=n_input_tokens,
         ):
-            full_reply_content += chunk
+            reply_chunks.append(chunk)
             yield chunk
+        full_reply_content = "".join(reply_chunks)
 
         if not skip_check:
             last_msg_exchange = (
@@ -293,12 +426,12 @@ class Chat(AlternativeConstructors):
                     prompt += f"\n```json\n{web_results_json_dumps}\n```\n"
                     prompt += f"\n`prompt`: '{original_prompt}'"
 
-                    full_reply_content += " "
+                    reply_chunks.append(" ")
                     yield " "
                     for chunk in self.respond_system_prompt(
                         prompt=prompt, add_to_history=False, skip_check=True
                     ):
-                        full_reply_content += chunk
+                        reply_chunks.append(chunk)
                         yield chunk
                 else:
                     yield self._translate(
@@ -310,25 +443,37 @@ class Chat(AlternativeConstructors):
             self.context_handler.add_to_history(
                 msg_list=[
                     prompt_msg,
-                    {"role": "assistant", "content": full_reply_content},
+                    {"role": "assistant", "content": "".join(reply_chunks)},
                 ]
             )
 
-    def start(self):
-        """Start the chat."""
+    def start(self, n_prompts_per_batch: int = 5):
+        """Start the chat.
+
+        Args:
+            n_prompts_per_batch (int): Number of prompts answered per API call when
+                prompts are piped in, i.e., when stdin is not a terminal.
+        """
         # ruff: noqa: T201
         print(f"{self.assistant_name}> {self.initial_greeting}\n")
+        interactive = sys.stdin.isatty()
+        if interactive:
+            n_prompts_per_batch = 1
+
+        questions = []
         try:
             while True:
-                question = input(f"{self.username}> ").strip()
+                question = input(f"{self.username}> " if interactive else "").strip()
                 if not question:
                     continue
-                print(f"{self.assistant_name}> ", end="", flush=True)
-                for chunk in self.respond_user_prompt(prompt=question):
-                    print(chunk, end="", flush=True)
-                print()
-                print()
+                questions.append(question)
+                if len(questions) >= n_prompts_per_batch:
+                    self._print_replies(questions=questions)
+                    questions = []
         except (KeyboardInterrupt, EOFError):
+            # Don't leave piped prompts unanswered
+            if questions:
+                self._print_replies(questions=questions)
             print("", end="\r")
             logger.info("Leaving chat.")
 
@@ -358,9 +503,30 @@ class Chat(AlternativeConstructors):
         msg = "Could not get a response right now."
         if error is not None:
             msg += f" The reason seems to be: {error}"
-            logger.opt(exception=True).debug(error)
+            logger.opt(exception=True).debug(msg)
         return msg
 
+    def _print_replies(self, questions: list[str]):
+        if len(questions) == 1:
+            print(f"{self.assistant_name}> ", end="", flush=True)
+            for chunk in self.respond_user_prompt(prompt=questions[0]):
+                print(chunk, end="", flush=True)
+            print()
+            print()
+            return
+
+        replies = self.respond_prompts(prompts=questions)
+        if len(replies) == len(questions):
+            for question, reply in zip(questions, replies):
+                print(f"{self.username}> {question}")
+                print(f"{self.assistant_name}> {reply}\n")
+            return
+
+        # The reply could not be split into one reply per question. Show it only once.
+        for question in questions:
+            print(f"{self.username}> {question}")
+        print(f"{self.assistant_name}> {replies[0]}\n")
+
     def _respond_prompt(self, prompt: str, role: str, **kwargs):
         prompt_as_msg = {"role": role.lower().strip(), "content": prompt.strip()}
         yield from self.yield_response_from_msg(prompt_as_msg, **kwargs)
@@ -389,10 +555,110 @@ class Chat(AlternativeConstructors):
 
         return translation
 
-    def __del__(self):
-        embedding_model = self.context_handler.database.get_embedding_model()
-        chat_started = embedding_model is not None
-        if self.private_mode or not chat_started:
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        # Discard cached values computed from the attribute that has just been changed
+        dependencies_by_property = self._cached_properties_dependencies
+        for cached_property_name, dependencies in dependencies_by_property.items():
+            if name in dependencies:
+                self.__dict__.pop(cached_property_name, None)
+        if name in self._config_fields:
+            self.__dict__["_configs_dirty"] = True
+        if name in ("id", "private_mode") and "_finalizer" in self.__dict__:
+            self._register_finalizer()
+
+    def close(self):
+        """Persist the chat's cache, or remove it if not needed. Safe to call twice."""
+        if self.__dict__.get("_closed"):
+            return
+
+        # The chat won't write to its databases anymore, whether or not they are kept
+        close_write_connections(directory=self._cache_dir_path)
+        if self.private_mode or not _chat_started(self.context_file_path):
             self.clear_cache()
         else:
             self.save_cache()
+        # Everything the finalizer would do is done
+        self._finalizer.detach()
+        self._closed = True
+
+    def _register_finalizer(self):
+        """Register the cleanup of the chat's cache if the chat is not closed.
+
+        The cleanup runs when the chat is garbage collected or, at the latest, at exit.
+        Unlike `__del__`, this also works at interpreter shutdown. The finalizer only
+        gets values, so it doesn't keep the chat alive. It is registered again if any
+        of these values changes.
+        """
+        if "_finalizer" in self.__dict__:
+            self._finalizer.detach()
+        self._finalizer = weakref.finalize(
+            self,
+            _finalize_chat_cache,
+            cache_dir=self._cache_dir_path,
+            context_file_path=self.context_file_path,
+            private_mode=self.private_mode,
+        )
+
+    def __del__(self):
+        # Only run the finalizer (once) earlier. See `_register_finalizer`.
+        finalizer = self.__dict__.get("_finalizer")
+        if finalizer is not None:
+            finalizer()
+
+
+def _chat_started(context_file_path: Path):
+    """Return whether any message exchange has been stored in the chat's context."""
+    # Check the file first, so as not to create the database just to find it empty
+    return (
+        context_file_path.exists()
+        and EmbeddingsDatabase(
+            db_path=context_file_path, embedding_model=None
+        ).get_embedding_model()
+        is not None
+    )
+
+
+def _finalize_chat_cache(cache_dir: Path, context_file_path: Path, private_mode: bool):
+    """Clean up the cache of a chat that has not been closed. See `Chat.close`.
+
+    The configs and metadata are not saved here, as that needs the chat itself. Chats
+    whose cache is to be kept must be closed or have `save_cache` called explicitly.
+    """
+    close_write_connections(directory=cache_dir)
+    if private_mode or not _chat_started(context_file_path):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def _split_batched_reply(reply: str, n_prompts: int):
+    """Split a reply to prompts batched by `Chat.respond_prompts` into single replies.
+
+    Args:
+        reply (str): The reply to the batched prompts.
+        n_prompts (int): The number of batched prompts.
+
+    Returns:
+        list[str]: The replies to each prompt, or None if `reply` doesn't contain the
+            answers to all prompts in the expected format.
+    """
+    # Splitting gives ["text before 1st marker", "[1]", "1", "reply 1", "[2]", ...]
+    split_reply = re.split(r"^(\s*\[(\d+)\])", reply, flags=re.MULTILINE)
+    preamble = split_reply[0]
+    replies = []
+    for marker, i_prompt, text in zip(
+        split_reply[1::3], split_reply[2::3], split_reply[3::3]
+    ):
+        if len(replies) < n_prompts and int(i_prompt) == len(replies) + 1:
+            replies.append(text)
+        elif replies:
+            # Not the marker of the next answer (e.g., a citation or a numbered list
+            # within an answer), so part of the current answer
+            replies[-1] += marker + text
+        else:
+            preamble += marker + text
+
+    if len(replies) < n_prompts:
+        return None
+    if preamble.strip():
+        logger.warning("Ignoring text before the answers: {}", preamble.strip())
+    return [prompt_reply.strip() for prompt_reply in replies]
@@ -1,6 +1,7 @@
 """Chat context/history management."""
 import ast
 import itertools
+import re
 from abc import ABC, abstractmethod
 from datetime import datetime, timezone
 from typing import TYPE_CHECKING
@@ -68,7 +69,7 @@ class ChatContext(ABC):
     def get_context(self, msg: dict):
         """Return messages to serve as context for `msg` when requesting a completion."""
         return _make_list_of_context_msgs(
-            history=self.select_relevant_history(msg=msg),
+            history=_compress_msgs(self.select_relevant_history(msg=msg)),
             system_name=self.parent_chat.system_name,
         )
 
@@ -103,18 +104,27 @@ class EmbeddingBasedChatContext(ChatContext):
 
     def request_embedding_for_text(self, text: str):
         """Request embedding for `text` from OpenAI according to used embedding model."""
+        cached_embedding = self.database.get_cached_embedding(text=text)
+        if cached_embedding is not None:
+            return cached_embedding
+
         embedding_request = request_embedding_from_openai(
             text=text, model=self.embedding_model
         )
 
         # Update parent chat's token usage db with tokens used in embedding request
+        tokens_usage = embedding_request["tokens_usage"]
         for db in [
             self.parent_chat.general_token_usage_db,
             self.parent_chat.token_usage_db,
         ]:
-            for comm_type, n_tokens in embedding_request["tokens_usage"].items():
-                input_or_output_kwargs = {f"n_{comm_type}_tokens": n_tokens}
-                db.insert_data(model=self.embedding_model, **input_or_output_kwargs)
+            db.insert_data(
+                model=self.embedding_model,
+                n_input_tokens=tokens_usage["input"],
+                n_output_tokens=tokens_usage["output"],
+            )
+
+        self.database.cache_embedding(text=text, embedding=embedding_request["embedding"])
 
         return embedding_request["embedding"]
 
@@ -151,6 +161,17 @@ def request_embedding_from_openai(text: str, model: str):
     return {"embedding": embedding, "tokens_usage": tokens_usage}
 
 
+def _compress_msgs(msgs: list[dict]):
+    """Drop superfluous whitespace from the contents of `msgs`."""
+    compressed_msgs = []
+    for msg in msgs:
+        # Leave indentation alone, as it matters in, e.g., code blocks
+        content = re.sub(r"[ \t]+$", "", msg["content"], flags=re.MULTILINE)
+        content = re.sub(r"\n{3,}", "\n\n", content).strip()
+        compressed_msgs.append({**msg, "content": content})
+    return compressed_msgs
+
+
 def _make_list_of_context_msgs(history: list[dict], system_name: str):
     sys_directives = "Considering the previous messages, answer the next message:"
     sys_msg = {"role": "system", "name": system_name, "content": sys_directives}
@@ -12,7 +12,9 @@ from .voice_chat import VoiceChat
 
 def voice_chat(args):
     """Start a voice-based chat."""
-    VoiceChat.from_cli_args(cli_args=args).start()
+    chat = VoiceChat.from_cli_args(cli_args=args)
+    chat.start()
+    chat.close()
 
 
 def browser_chat(args):
@@ -37,9 +39,10 @@ def browser_chat(args):
 def terminal_chat(args):
     """Run the chat on the terminal."""
     chat = Chat.from_cli_args(cli_args=args)
-    chat.start()
+    chat.start(n_prompts_per_batch=args.n_prompts_per_batch)
     if args.report_accounting_when_done:
         chat.report_token_usage(report_general=True)
+    chat.close()
 
 
 def accounting_report(args):
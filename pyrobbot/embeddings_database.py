@@ -1,5 +1,6 @@
 """Management of embeddings/chat history storage and retrieval."""
 import datetime
+import hashlib
 import json
 import sqlite3
 from pathlib import Path
@@ -45,10 +46,21 @@ class EmbeddingsDatabase:
         )
         """
 
+        # SQL to create 'embeddings_cache' table, to avoid re-requesting embeddings
+        create_embeddings_cache_table = """
+        CREATE TABLE IF NOT EXISTS embeddings_cache (
+            embedding_model TEXT NOT NULL,
+            text_hash TEXT NOT NULL,
+            embedding TEXT NOT NULL,
+            PRIMARY KEY (embedding_model, text_hash)
+        )
+        """
+
         with conn:
             # Create tables
             conn.execute(create_embedding_model_table)
             conn.execute(create_messages_table)
+            conn.execute(create_embeddings_cache_table)
 
             # Triggers to prevent modification after insertion
             conn.execute(
@@ -105,24 +117,67 @@ class EmbeddingsDatabase:
         Raises:
             ValueError: If the database already contains a different embedding model.
         """
-        stored_embedding_model = self.get_embedding_model()
-        if stored_embedding_model is None:
-            self._init_database()
-        elif stored_embedding_model != self.embedding_model:
-            raise ValueError(
-                "Database already contains a different embedding model: "
-                f"{self.get_embedding_model()}.\n"
-                "Cannot continue."
-            )
-
         timestamp = int(datetime.datetime.utcnow().timestamp())
         message_exchange = json.dumps(message_exchange)
         embedding = json.dumps(embedding)
-        conn = sqlite3.connect(self.db_path)
         sql = "INSERT INTO messages "
         sql += "(timestamp, chat_model, message_exchange, embedding) VALUES (?, ?, ?, ?);"
+
+        # Check the embedding model and insert the messages in a single transaction
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE;")
+                result = conn.execute(
+                    "SELECT embedding_model FROM embedding_model;"
+                ).fetchone()
+                stored_embedding_model = result[0] if result else None
+                if stored_embedding_model is None:
+                    self._init_database(conn=conn)
+                elif stored_embedding_model != self.embedding_model:
+                    raise ValueError(
+                        "Database already contains a different embedding model: "
+                        f"{stored_embedding_model}.\n"
+                        "Cannot continue."
+                    )
+                conn.execute(sql, (timestamp, chat_model, message_exchange, embedding))
+        finally:
+            conn.close()
+
+    def get_cached_embedding(self, text: str):
+        """Retrieve the cached embedding for `text`, if any.
+
+        Args:
+            text (str): The text whose embedding is to be retrieved.
+
+        Returns:
+            list: The embedding or None if no embedding for `text` has been cached.
+        """
+        conn = sqlite3.connect(self.db_path)
+        query = "SELECT embedding FROM embeddings_cache "
+        query += "WHERE embedding_model = ? AND text_hash = ?;"
         with conn:
-            conn.execute(sql, (timestamp, chat_model, message_exchange, embedding))
+            cur = conn.cursor()
+            cur.execute(query, (self.embedding_model, _get_text_hash(text)))
+            result = cur.fetchone()
+        conn.close()
+
+        return json.loads(result[0]) if result else None
+
+    def cache_embedding(self, text: str, embedding):
+        """Store the embedding for `text` in the database's 'embeddings_cache' table.
+
+        Args:
+            text (str): The text the embedding was requested for.
+            embedding: The embedding associated with `text`.
+        """
+        conn = sqlite3.connect(self.db_path)
+        sql = "INSERT OR IGNORE INTO embeddings_cache "
+        sql += "(embedding_model, text_hash, embedding) VALUES (?, ?, ?);"
+        with conn:
+            conn.execute(
+                sql, (self.embedding_model, _get_text_hash(text), json.dumps(embedding))
+            )
         conn.close()
 
     def get_messages_dataframe(self):
@@ -137,12 +192,13 @@ class EmbeddingsDatabase:
         conn.close()
         return messages_df
 
-    def _init_database(self):
-        """Initialise the 'embedding_model' table in the database."""
-        conn = sqlite3.connect(self.db_path)
+    def _init_database(self, conn: sqlite3.Connection):
+        """Initialise the 'embedding_model' table in the database using `conn`."""
         create_time = int(datetime.datetime.utcnow().timestamp())
         sql = "INSERT INTO embedding_model "
         sql += "(created_timestamp, embedding_model) VALUES (?, ?);"
-        with conn:
-            conn.execute(sql, (create_time, self.embedding_model))
-        conn.close()
+        conn.execute(sql, (create_time, self.embedding_model))
+
+
+def _get_text_hash(text: str):
+    return hashlib.sha256(text.strip().encode("utf-8")).hexdigest()
@@ -10,6 +10,13 @@ import httpx
 import openai
 from loguru import logger
 
+try:
+    import orjson
+
+    _orjson_imported = True
+except ImportError:
+    _orjson_imported = False
+
 
 class ReachedMaxNumberOfAttemptsError(Exception):
     """Error raised when the max number of attempts has been reached."""
@@ -64,6 +71,20 @@ def retry(
     return retry_decorator
 
 
+def json_dumps(obj):
+    """Serialise `obj` to a compact JSON string. Use `orjson` if available."""
+    if _orjson_imported:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def json_loads(json_str: str):
+    """Deserialise `json_str`. Use `orjson` if available, as it is faster."""
+    if _orjson_imported:
+        return orjson.loads(json_str)
+    return json.loads(json_str)
+
+
 class AlternativeConstructors:
     """Mixin class for alternative constructors."""
 
@@ -114,9 +135,9 @@ class AlternativeConstructors:
         """
         try:
             with open(cache_dir / "configs.json", "r") as configs_f:
-                new = cls.from_dict(json.load(configs_f))
+                new = cls.from_dict(json_loads(configs_f.read()))
             with open(cache_dir / "metadata.json", "r") as metadata_f:
-                new.metadata = json.load(metadata_f)
+                new.metadata = json_loads(metadata_f.read())
                 new.id = new.metadata["chat_id"]
         except FileNotFoundError:
             logger.warning(
@@ -1,53 +1,63 @@
 """Utils for using the OpenAI API."""
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional
 
 import openai
 
 from .chat_configs import OpenAiApiCallOptions
 from .general_utils import retry
-from .tokens import get_n_tokens_from_msgs
+from .tokens import get_encoding, get_n_tokens_from_msgs
 
 if TYPE_CHECKING:
     from .chat import Chat
 
+_API_CALL_FIELDS = tuple(OpenAiApiCallOptions.model_fields)
 
-def make_api_chat_completion_call(conversation: list, chat_obj: "Chat"):
+
+def make_api_chat_completion_call(
+    conversation: list, chat_obj: "Chat", n_input_tokens: Optional[int] = None
+):
     """Stream a chat completion from OpenAI API given a conversation and a chat object.
 
     Args:
         conversation (list): A list of messages passed as input for the completion.
         chat_obj (Chat): Chat object containing the configurations for the chat.
+        n_input_tokens (int, optional): Number of tokens in `conversation`, if known
+            beforehand. Computed from `conversation` if not passed.
 
     Yields:
         str: Chunks of text generated by the API in response to the conversation.
     """
     api_call_args = {}
-    for field in OpenAiApiCallOptions.model_fields:
+    for field in _API_CALL_FIELDS:
         if getattr(chat_obj, field) is not None:
             api_call_args[field] = getattr(chat_obj, field)
 
+    if n_input_tokens is None:
+        n_input_tokens = get_n_tokens_from_msgs(
+            messages=conversation, encoder=get_encoding(chat_obj.model)
+        )
+
     @retry(error_msg="Problems connecting to OpenAI API")
     def stream_reply(conversation, **api_call_args):
         # Update the chat's token usage database with tokens used in chat input
         # Do this here because every attempt consumes tokens, even if it fails
-        n_tokens = get_n_tokens_from_msgs(messages=conversation, model=chat_obj.model)
         for db in [chat_obj.general_token_usage_db, chat_obj.token_usage_db]:
-            db.insert_data(model=chat_obj.model, n_input_tokens=n_tokens)
+            db.insert_data(model=chat_obj.model, n_input_tokens=n_input_tokens)
 
-        full_reply_content = ""
+        n_output_tokens = 0
         for completion_chunk in openai.chat.completions.create(
             messages=conversation, stream=True, **api_call_args
         ):
             reply_chunk = getattr(completion_chunk.choices[0].delta, "content", "")
             if reply_chunk is None:
                 break
-            full_reply_content += reply_chunk
+            # Each streamed chunk carries one token, so no need to re-tokenize the reply
+            if reply_chunk:
+                n_output_tokens += 1
             yield reply_chunk
 
         # Update the chat's token usage database with tokens used in chat output
-        reply_as_msg = {"role": "assistant", "content": full_reply_content}
-        n_tokens = get_n_tokens_from_msgs(messages=[reply_as_msg], model=chat_obj.model)
         for db in [chat_obj.general_token_usage_db, chat_obj.token_usage_db]:
-            db.insert_data(model=chat_obj.model, n_output_tokens=n_tokens)
+            db.insert_data(model=chat_obj.model, n_output_tokens=n_output_tokens)
 
     yield from stream_reply(conversation, **api_call_args)
@@ -1,6 +1,9 @@
 """Management of token usage and costs for OpenAI API."""
+import atexit
 import datetime
 import sqlite3
+import threading
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 
@@ -27,6 +30,32 @@ PRICE_PER_K_TOKENS = {
     "whisper-1": {"input": 0.006, "output": 0.0},
 }
 
+# Computed once here, as TokenUsageDatabase instances are created very often
+_PRICE_PER_TOKEN = {
+    model: {k: v / 1000.0 for k, v in price_per_k_tokens.items()}
+    for model, price_per_k_tokens in PRICE_PER_K_TOKENS.items()
+}
+
+# Settings applied to every connection to the token usage databases. WAL journaling
+# lets readers and the writer work concurrently without blocking each other. The busy
+# timeout is set first, as switching to WAL may have to wait for a lock held elsewhere.
+_SQLITE_PRAGMAS = (
+    "PRAGMA busy_timeout=5000;",
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA cache_size=-20000;",
+    "PRAGMA temp_store=memory;",
+)
+
+# All writes to a given database file go through a single connection shared among all
+# TokenUsageDatabase instances (and threads). Writes are serialised by this lock, which
+# is reentrant so that, e.g., a `Chat.__del__` run by the GC cannot deadlock on it.
+_write_lock = threading.RLock()
+_write_connections: dict[Path, sqlite3.Connection] = {}
+
+# Every reply is primed with <im_start>assistant
+N_TOKENS_REPLY_PRIMING = 2
+
 
 class TokenUsageDatabase:
     """Manages a database to store estimated token usage and costs for OpenAI API."""
@@ -34,36 +63,29 @@ class TokenUsageDatabase:
     def __init__(self, fpath: Path):
         """Initialize a TokenUsageDatabase instance."""
         self.fpath = fpath
-        self.token_price = {}
-        for model, price_per_k_tokens in PRICE_PER_K_TOKENS.items():
-            self.token_price[model] = {
-                k: v / 1000.0 for k, v in price_per_k_tokens.items()
-            }
+        self.token_price = _PRICE_PER_TOKEN
 
         self.create()
 
     def create(self):
         """Create the database if it doesn't exist."""
         self.fpath.parent.mkdir(parents=True, exist_ok=True)
-        conn = sqlite3.connect(self.fpath)
-        cursor = conn.cursor()
-
-        # Create a table to store the data with 'timestamp' as the primary key
-        cursor.execute(
+        with _write_lock:
+            conn = self._get_write_connection()
+            # Create a table to store the data with 'timestamp' as the primary key
+            with conn:
+                conn.execute(
+                    """
+                CREATE TABLE IF NOT EXISTS token_costs (
+                    timestamp INTEGER NOT NULL,
+                    model TEXT NOT NULL,
+                    n_input_tokens INTEGER NOT NULL,
+                    n_output_tokens INTEGER NOT NULL,
+                    cost_input_tokens REAL NOT NULL,
+                    cost_output_tokens REAL NOT NULL
+                )
             """
-            CREATE TABLE IF NOT EXISTS token_costs (
-                timestamp INTEGER NOT NULL,
-                model TEXT NOT NULL,
-                n_input_tokens INTEGER NOT NULL,
-                n_output_tokens INTEGER NOT NULL,
-                cost_input_tokens REAL NOT NULL,
-                cost_output_tokens REAL NOT NULL
-            )
-        """
-        )
-
-        conn.commit()
-        conn.close()
+                )
 
     def insert_data(
         self,
@@ -73,41 +95,52 @@ class TokenUsageDatabase:
         timestamp: Optional[int] = None,
     ):
         """Insert the data into the token_costs table."""
-        if model is None:
-            return
-
-        conn = sqlite3.connect(self.fpath)
-        cursor = conn.cursor()
-
-        # Insert the data into the table
-        cursor.execute(
-            """
-        INSERT INTO token_costs (
-            timestamp,
-            model,
-            n_input_tokens,
-            n_output_tokens,
-            cost_input_tokens,
-            cost_output_tokens
+        self.insert_many(
+            rows=[(model, n_input_tokens, n_output_tokens)], timestamp=timestamp
         )
-        VALUES (?, ?, ?, ?, ?, ?)
-        """,
+
+    def insert_many(
+        self, rows: list[tuple[str, int, int]], timestamp: Optional[int] = None
+    ):
+        """Insert `(model, n_input_tokens, n_output_tokens)` rows in one transaction."""
+        timestamp = timestamp or int(datetime.datetime.utcnow().timestamp())
+        data = [
             (
-                timestamp or int(datetime.datetime.utcnow().timestamp()),
+                timestamp,
                 model,
                 n_input_tokens,
                 n_output_tokens,
                 n_input_tokens * self.token_price[model]["input"],
                 n_output_tokens * self.token_price[model]["output"],
-            ),
-        )
+            )
+            for model, n_input_tokens, n_output_tokens in rows
+            if model is not None
+        ]
+        if not data:
+            return
 
-        conn.commit()
-        conn.close()
+        with _write_lock:
+            conn = self._get_write_connection()
+            # Write transactions take the write lock upfront ("BEGIN IMMEDIATE")
+            with conn:
+                conn.executemany(
+                    """
+                INSERT INTO token_costs (
+                    timestamp,
+                    model,
+                    n_input_tokens,
+                    n_output_tokens,
+                    cost_input_tokens,
+                    cost_output_tokens
+                )
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                    data,
+                )
 
     def get_usage_balance_dataframe(self):
         """Get a dataframe with the accumulated token usage and costs."""
-        conn = sqlite3.connect(self.fpath)
+        conn = self._connect()
         query = """
             SELECT
                 model as Model,
@@ -141,15 +174,73 @@ class TokenUsageDatabase:
 
         return usage_df
 
+    def _connect(self, **kwargs):
+        """Return a connection to the database with the appropriate settings applied."""
+        conn = sqlite3.connect(self.fpath, isolation_level="IMMEDIATE", **kwargs)
+        for pragma in _SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
 
-def get_n_tokens_from_msgs(messages: list[dict], model: str):
-    """Returns the number of tokens used by a list of messages."""
-    # Adapted from
-    # <https://platform.openai.com/docs/guides/text-generation/managing-tokens>
+    def _get_write_connection(self):
+        """Return the write connection shared by all users of the database file.
+
+        Must only be called, and the returned connection used, with `_write_lock` held.
+        """
+        try:
+            return _write_connections[self.fpath]
+        except KeyError:
+            conn = self._connect(check_same_thread=False)
+            _write_connections[self.fpath] = conn
+            return conn
+
+
+@atexit.register
+def close_write_connections(directory: Optional[Path] = None):
+    """Close the shared write connections to databases located under `directory`.
+
+    All shared write connections are closed if `directory` is not passed. This must be
+    done, e.g., before the databases' files are removed.
+
+    Args:
+        directory (Path, optional): Directory containing the databases.
+    """
+    with _write_lock:
+        for fpath in list(_write_connections):
+            if directory is None or fpath.is_relative_to(directory):
+                _write_connections.pop(fpath).close()
+
+
+@lru_cache(maxsize=8)
+def get_encoding(model: str):
+    """Return the (cached) tiktoken encoding used by `model`.
+
+    Creating an encoding is expensive, so this is done only once per model.
+    """
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def get_n_tokens_from_msgs(
+    messages: list[dict],
+    model: Optional[str] = None,
+    encoder: Optional[tiktoken.Encoding] = None,
+):
+    """Returns the number of tokens used by a list of messages.
+
+    Args:
+        messages (list[dict]): The messages whose tokens are to be counted.
+        model (str, optional): The model whose encoding should be used. Ignored if
+            `encoder` is passed.
+        encoder (tiktoken.Encoding, optional): The encoding to be used.
+
+    Returns:
+        int: The estimated number of tokens used by `messages`.
+    """
+    # Adapted from
+    # <https://platform.openai.com/docs/guides/text-generation/managing-tokens>
+    encoding = encoder or get_encoding(model)
 
     # OpenAI's original function was implemented for gpt-3.5-turbo-0613, but we'll use
     # it for all models for now. We are only intereste dinestimates, after all.
@@ -161,7 +252,7 @@ def get_n_tokens_from_msgs(messages: list[dict], model: str):
             num_tokens += len(encoding.encode(value))
             if key == "name":  # if there's a name, the role is omitted
                 num_tokens += -1  # role is always required and always 1 token
-    num_tokens += 2  # every reply is primed with <im_start>assistant
+    num_tokens += N_TOKENS_REPLY_PRIMING
     return num_tokens
 
 
@@ -11,6 +11,13 @@ def test_default_command():
     assert args.command == "voice"
 
 
+def test_terminal_command_accepts_n_prompts_per_batch():
+    n_prompts_per_batch = 2
+    argv = ["terminal", "--n-prompts-per-batch", str(n_prompts_per_batch)]
+    args = get_parsed_args(argv=argv)
+    assert args.n_prompts_per_batch == n_prompts_per_batch
+
+
 @pytest.mark.usefixtures("_input_builtin_mocker")
 @pytest.mark.parametrize("user_input", ["Hi!", ""], ids=["regular-input", "empty-input"])
 def test_terminal_command(cli_args_overrides):
@@ -1,8 +1,13 @@
+import datetime
+import gc
+import weakref
+
 import openai
 import pytest
 
-from pyrobbot import GeneralConstants
+from pyrobbot import GeneralConstants, tokens
 from pyrobbot.chat import Chat
+from pyrobbot.tokens import N_TOKENS_REPLY_PRIMING, get_n_tokens_from_msgs
 
 
 @pytest.mark.order(1)
@@ -67,6 +72,186 @@ def test_can_read_chat_from_cache(default_chat):
     assert new_chat.configs == default_chat.configs
 
 
+def test_changing_returned_configs_does_not_affect_chat(default_chat):
+    configs = default_chat.configs
+    configs.assistant_name = "Not" + default_chat.assistant_name
+    assert default_chat.configs.assistant_name == default_chat.assistant_name
+
+
+def test_reassigned_config_field_is_reflected_in_configs(default_chat):
+    _ = default_chat.configs
+    default_chat.assistant_name = "Not" + default_chat.assistant_name
+    assert default_chat.configs.assistant_name == default_chat.assistant_name
+
+
+@pytest.mark.parametrize("llm_model", ["gpt-3.5-turbo"])
+@pytest.mark.parametrize(
+    ("attribute", "new_value"),
+    [
+        ("assistant_name", "Bartholomew"),
+        ("model", "gpt-4"),
+        ("ai_instructions", ("Talk like a pirate.",)),
+    ],
+)
+def test_base_directive_is_updated_when_its_attributes_change(
+    default_chat, attribute, new_value
+):
+    old_directive = default_chat.base_directive
+    old_n_tokens = default_chat._base_directive_n_tokens
+    setattr(default_chat, attribute, new_value)
+
+    new_directive = default_chat.base_directive
+    assert new_directive != old_directive
+    assert "".join(new_value) in new_directive["content"]
+    expected_n_tokens = (
+        get_n_tokens_from_msgs(messages=[new_directive], model=default_chat.model)
+        - N_TOKENS_REPLY_PRIMING
+    )
+    assert default_chat._base_directive_n_tokens == expected_n_tokens
+    assert expected_n_tokens != old_n_tokens
+
+
+def test_base_directive_is_updated_when_date_changes(default_chat, mocker):
+    old_directive = default_chat.base_directive
+    _ = default_chat._base_directive_n_tokens
+    mocked_datetime = mocker.patch("pyrobbot.chat.datetime")
+    mocked_datetime.date.today.return_value = datetime.date(2000, 1, 1)
+
+    new_directive = default_chat.base_directive
+    assert "Saturday, 2000-01-01" in new_directive["content"]
+    assert new_directive["content"] != old_directive["content"]
+    expected_n_tokens = (
+        get_n_tokens_from_msgs(messages=[new_directive], model=default_chat.model)
+        - N_TOKENS_REPLY_PRIMING
+    )
+    assert default_chat._base_directive_n_tokens == expected_n_tokens
+    assert default_chat.base_directive is new_directive
+
+
+def test_changing_id_moves_cache_files(default_chat):
+    old_files = [
+        default_chat.configs_file,
+        default_chat.metadata_file,
+        default_chat.context_file_path,
+    ]
+    default_chat.id = "foobar"
+    new_files = [
+        default_chat.configs_file,
+        default_chat.metadata_file,
+        default_chat.context_file_path,
+    ]
+    for old_file, new_file in zip(old_files, new_files):
+        assert new_file != old_file
+        assert new_file.name == old_file.name
+        assert new_file.parent == default_chat.cache_dir
+
+
 def test_create_from_cache_returns_default_chat_if_invalid_cachedir(default_chat, caplog):
     _ = Chat.from_cache(default_chat.cache_dir / "foobar")
     assert "Creating Chat with default configs" in caplog.text
+
+
+@pytest.mark.parametrize("context_model", ["text-embedding-ada-002"])
+def test_embeddings_are_cached(default_chat, mocker):
+    embeddings_create = mocker.spy(openai.resources.embeddings.Embeddings, "create")
+    context_handler = default_chat.context_handler
+    first_embedding = context_handler.request_embedding_for_text(text="Hi!")
+    second_embedding = context_handler.request_embedding_for_text(text="Hi!")
+    assert second_embedding == first_embedding
+    assert embeddings_create.call_count == 1
+
+
+def test_respond_prompts_splits_batched_reply(default_chat, mocker):
+    mocker.patch.object(
+        default_chat,
+        "respond_user_prompt",
+        return_value=iter(["[1] Foo.\n", "[2] Bar", "."]),
+    )
+    assert default_chat.respond_prompts(["Foo?", "Bar?"]) == ["Foo.", "Bar."]
+
+
+@pytest.mark.parametrize(
+    ("reply", "expected_replies"),
+    [
+        ("[1] Foo:\n[1] Baz\n[2] Bar.\n[3] Qux", ["Foo:\n[1] Baz", "Bar.\n[3] Qux"]),
+        ("Sure!\n[1] Foo.\n[2] Bar.", ["Foo.", "Bar."]),
+        ("1. Foo.\n2. Bar.", ["1. Foo.\n2. Bar."]),
+        ("[2] Bar.\n[1] Foo.", ["[2] Bar.\n[1] Foo."]),
+    ],
+    ids=["stray-markers", "text-before-answers", "not-numbered", "out-of-order"],
+)
+def test_respond_prompts_handles_unexpected_reply_format(
+    default_chat, mocker, reply, expected_replies
+):
+    mocker.patch.object(default_chat, "respond_user_prompt", return_value=iter([reply]))
+    assert default_chat.respond_prompts(["Foo?", "Bar?"]) == expected_replies
+
+
+def test_unsplittable_batched_reply_is_printed_once(default_chat, mocker, capsys):
+    reply = "1. Foo.\n2. Bar."
+    mocker.patch.object(default_chat, "respond_user_prompt", return_value=iter([reply]))
+    default_chat._print_replies(questions=["Foo?", "Bar?"])
+    output = capsys.readouterr().out
+    assert output.count(reply) == 1
+    assert "Foo?" in output
+    assert "Bar?" in output
+
+
+def test_close_releases_write_connections_of_saved_chat(default_chat):
+    default_chat.private_mode = False
+    _ = "".join(default_chat.respond_user_prompt(prompt="Hi!"))
+    default_chat.close()
+    assert default_chat.configs_file.exists()
+    assert not [
+        fpath
+        for fpath in tokens._write_connections
+        if fpath.is_relative_to(default_chat.cache_dir)
+    ]
+
+
+def test_unclosed_chat_is_finalized_without_being_kept_alive(default_chat_configs):
+    chat = Chat(configs=default_chat_configs)
+    chat.private_mode = True
+    _ = "".join(chat.respond_user_prompt(prompt="Hi!"))
+    cache_dir = chat.cache_dir
+    chat_ref = weakref.ref(chat)
+    del chat
+    gc.collect()
+    assert chat_ref() is None
+    assert not cache_dir.exists()
+
+
+def test_finalizer_keeps_cache_of_started_chat(default_chat):
+    default_chat.private_mode = False
+    _ = "".join(default_chat.respond_user_prompt(prompt="Hi!"))
+    default_chat.save_cache()
+    cache_dir = default_chat.cache_dir
+    default_chat._finalizer()
+    assert default_chat.configs_file.exists()
+    assert not [
+        fpath for fpath in tokens._write_connections if fpath.is_relative_to(cache_dir)
+    ]
+
+
+def test_respond_prompts_returns_empty_list_if_no_prompts(default_chat, mocker):
+    respond_user_prompt = mocker.spy(default_chat, "respond_user_prompt")
+    assert default_chat.respond_prompts([]) == []
+    respond_user_prompt.assert_not_called()
+
+
+def test_interactive_chat_streams_replies(default_chat, mocker):
+    mocker.patch("sys.stdin", **{"isatty.return_value": True})
+    mocker.patch("builtins.input", side_effect=["Hi!", EOFError])
+    respond_user_prompt = mocker.spy(default_chat, "respond_user_prompt")
+    respond_prompts = mocker.spy(default_chat, "respond_prompts")
+    default_chat.start()
+    respond_user_prompt.assert_called_once_with(prompt="Hi!")
+    respond_prompts.assert_not_called()
+
+
+def test_piped_prompts_pending_at_end_of_input_are_answered(default_chat, mocker):
+    mocker.patch("sys.stdin", **{"isatty.return_value": False})
+    mocker.patch("builtins.input", side_effect=["Hi!", "Bye!", EOFError])
+    respond_prompts = mocker.spy(default_chat, "respond_prompts")
+    default_chat.start()
+    respond_prompts.assert_called_once_with(prompts=["Hi!", "Bye!"])
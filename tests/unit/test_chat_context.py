@@ -0,0 +1,40 @@
+import pytest
+
+from pyrobbot.chat_context import _compress_msgs
+
+
+def _compress_content(content: str):
+    return _compress_msgs([{"role": "user", "content": content}])[0]["content"]
+
+
+@pytest.mark.parametrize(
+    ("content", "expected_content"),
+    [
+        ("Hi!   \nHow are you?\t\n", "Hi!\nHow are you?"),
+        ("Hi!\n\n\n\nHow are you?", "Hi!\n\nHow are you?"),
+        ("Hi!\n\nHow are you?", "Hi!\n\nHow are you?"),
+        ("  Hi!  ", "Hi!"),
+    ],
+    ids=["trailing-whitespace", "blank-lines", "single-blank-line", "surrounding"],
+)
+def test_compress_msgs_drops_superfluous_whitespace(content, expected_content):
+    assert _compress_content(content) == expected_content
+
+
+def test_compress_msgs_keeps_indentation_in_code_blocks():
+    content = "Here:\n```python\ndef foo():\n    if True:\n        return 1\n```"
+    assert _compress_content(content) == content
+
+
+def test_compress_msgs_keeps_other_msg_fields_and_order():
+    msgs = [
+        {"role": "user", "content": "Hi!  ", "timestamp": 1},
+        {"role": "assistant", "content": "Hi!  "},
+        {"role": "user", "content": "Hi!"},
+    ]
+    assert _compress_msgs(msgs) == [
+        {"role": "user", "content": "Hi!", "timestamp": 1},
+        {"role": "assistant", "content": "Hi!"},
+        {"role": "user", "content": "Hi!"},
+    ]
+    assert msgs[0]["content"] == "Hi!  "
@@ -0,0 +1,50 @@
+import sqlite3
+
+import pytest
+
+from pyrobbot import tokens
+from pyrobbot.tokens import TokenUsageDatabase
+
+
+@pytest.fixture()
+def token_usage_db(tmp_path):
+    database = TokenUsageDatabase(fpath=tmp_path / "token_usage.db")
+    yield database
+    tokens.close_write_connections(directory=tmp_path)
+
+
+@pytest.fixture()
+def executed_statements(token_usage_db):
+    statements = []
+    tokens._write_connections[token_usage_db.fpath].set_trace_callback(statements.append)
+    return statements
+
+
+def _stored_rows(database):
+    with sqlite3.connect(database.fpath) as conn:
+        return conn.execute(
+            "SELECT timestamp, model, n_input_tokens, n_output_tokens FROM token_costs"
+        ).fetchall()
+
+
+def test_insert_many_inserts_all_rows_in_one_transaction(
+    token_usage_db, executed_statements
+):
+    rows = [("gpt-4", 10, 20), ("gpt-3.5-turbo", 30, 40), ("tts-1", 50, 0)]
+    token_usage_db.insert_many(rows=rows, timestamp=1)
+
+    assert sorted(_stored_rows(token_usage_db)) == sorted((1, *row) for row in rows)
+    begin_statements = [s for s in executed_statements if s.startswith("BEGIN")]
+    assert len(begin_statements) == 1
+
+
+def test_insert_many_skips_rows_without_model(token_usage_db):
+    token_usage_db.insert_many(rows=[(None, 10, 20), ("gpt-4", 30, 40)], timestamp=1)
+    assert _stored_rows(token_usage_db) == [(1, "gpt-4", 30, 40)]
+
+
+def test_insert_many_writes_nothing_if_no_rows(token_usage_db, executed_statements):
+    token_usage_db.insert_many(rows=[])
+    token_usage_db.insert_many(rows=[(None, 10, 20)])
+    assert _stored_rows(token_usage_db) == []
+    assert executed_statements == []